@@ -1,8 +1,11 @@
 import streamlit as st
-from groq import Groq
+from groq import Groq, APIConnectionError, APIStatusError
 from PIL import Image
-import base64
+import pybase64 as b64
 from io import BytesIO
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # ==========================================
 # [설정] 페이지 기본 설정 (가장 먼저 실행)
@@ -34,75 +37,164 @@ except (FileNotFoundError, KeyError):
     st.info("💡 [로컬 실행] .streamlit/secrets.toml 파일을 확인해주세요.")
     st.stop()
 
+# ==========================================
+# [설정] 시스템 프롬프트 (Groq 프롬프트 캐시 적중을 위해 고정 문자열 유지)
+# ==========================================
+SYSTEM_PROMPT = """
+You are an elite AI researcher writing the **"Proposed Method"** section for a top-tier conference paper (e.g., CVPR, NeurIPS).
+
+**GOAL:** Analyze the attached architecture diagrams and write a **cohesive, logically flowing** description of the proposed framework.
+
+**INSTRUCTIONS:**
+1. **Narrative Flow:** Do NOT force the text into too many sub-sections. Prioritize a smooth narrative.
+2. **Synthesis:** Synthesize multiple images into a single coherent explanation.
+3. **Academic Tone:** Use high-level academic English and **LaTeX** for variables ($x$, $L_{total}$).
+4. **Detail:** Describe exactly what happens in the pipeline, transitioning naturally between components.
+
+Start writing the "Proposed Method" section once you receive the diagrams and context info.
+"""
+
+# 실행마다 바뀌는 컨텍스트 템플릿 (domain, n 두 칸만 채움)
+CONTEXT_TEMPLATE = """
+[Context Info]
+- **Domain:** {domain}
+- **Visual Input:** {n} unique diagram(s).
+"""
+
+# 선택 가능한 비전 모델 (이전 11b/90b-preview 모델은 종료되어 제외)
+MODELS = {
+    "Llama 4 Scout": "meta-llama/llama-4-scout-17b-16e-instruct",
+    "Llama 4 Maverick": "meta-llama/llama-4-maverick-17b-128e-instruct",
+}
+
+# 비전 입력 이미지의 기본 최대 변 길이 (작은 글씨가 많으면 1024로 상향)
+DEFAULT_MAX_SIDE = 768
+
+# 재시도할 Groq 응답 상태 코드 (타임아웃, 요청 한도 초과, 서버 오류)
+# Groq 클라이언트의 자체 재시도는 끄고(max_retries=0) 이 목록으로만 재시도
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
 # ==========================================
 # [함수] 이미지 변환 (리사이징 추가)
 # ==========================================
-def encode_image_to_base64(image):
-    # Llama 4는 4MB 제한이 엄격하므로, 이미지가 너무 크면 리사이징
-    max_size = (1024, 1024)
-    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+@st.cache_data(show_spinner=False, max_entries=32)
+def encode_image_to_base64(raw_bytes, max_side=DEFAULT_MAX_SIDE):
+    # 동일한 이미지 바이트는 재실행 시 캐시된 결과를 그대로 사용
+    image = Image.open(BytesIO(raw_bytes))
+
+    # Llama 4는 4MB 제한이 엄격하고 픽셀 수에 비례해 비전 토큰이 늘어나므로 리사이징
+    max_size = (max_side, max_side)
+
+    # 이미 크기/포맷 조건을 만족하는 JPEG는 디코딩 없이 원본 그대로 사용
+    if (
+        image.format == "JPEG"
+        and image.mode == "RGB"
+        and max(image.size) <= max_size[0]
+        and len(raw_bytes) <= 4 * 1024 * 1024
+    ):
+        return "image/jpeg", b64.b64encode_as_string(raw_bytes)
+
+    # JPEG는 디코딩 단계에서 1/2~1/8로 축소 (PNG는 영향 없음)
+    image.draft("RGB", max_size)
+    image.thumbnail(max_size, Image.Resampling.BILINEAR)
     
     buffered = BytesIO()
     image = image.convert("RGB")
-    image.save(buffered, format="JPEG", quality=85) # 용량 최적화
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    # 다이어그램류는 WebP가 같은 화질에서 JPEG보다 용량이 작음
+    image.save(buffered, format="WEBP", quality=85, method=4) # 용량 최적화
+    return "image/webp", b64.b64encode_as_string(buffered.getvalue())
+
+# ==========================================
+# [함수] Groq 클라이언트 (재실행 간 연결 재사용)
+# ==========================================
+@st.cache_resource(show_spinner=False)
+def get_groq(api_key):
+    # 재시도는 generate_natural_method의 백오프 루프 한 곳에서만 처리
+    return Groq(api_key=api_key, max_retries=0)
 
 # ==========================================
 # [함수] 자연스러운 논문 생성 로직
 # ==========================================
-def generate_natural_method(api_key, domain_text, image_list):
-    client = Groq(api_key=api_key)
-    
-    # 1. 텍스트 프롬프트 구성
-    user_prompt = f"""
-    You are an elite AI researcher writing the **"Proposed Method"** section for a top-tier conference paper (e.g., CVPR, NeurIPS).
-    
-    **GOAL:** Analyze the attached architecture diagrams and write a **cohesive, logically flowing** description of the proposed framework.
+def generate_natural_method(api_key, domain_text, image_list, model_id, max_side):
+    client = get_groq(api_key)
     
-    **INSTRUCTIONS:**
-    1. **Narrative Flow:** Do NOT force the text into too many sub-sections. Prioritize a smooth narrative.
-    2. **Synthesis:** Synthesize multiple images into a single coherent explanation.
-    3. **Academic Tone:** Use high-level academic English and **LaTeX** for variables ($x$, $L_{{total}}$).
-    4. **Detail:** Describe exactly what happens in the pipeline, transitioning naturally between components.
-
-    [Context Info]
-    - **Domain:** {domain_text}
-    - **Visual Input:** {len(image_list)} diagram(s).
-    
-    Start writing the "Proposed Method" section now.
-    """
+    # 1. 가변 컨텍스트 구성 (변하는 부분만 마지막에 배치)
+    context_msg = CONTEXT_TEMPLATE.format(domain=domain_text, n=len(image_list))
 
     # 2. 메시지 페이로드 구성
-    content_payload = [{"type": "text", "text": user_prompt}]
+    content_payload = []
+
+    # 이미지 인코딩은 PIL 내부에서 GIL을 해제하므로 스레드로 병렬 처리
+    with ThreadPoolExecutor(max_workers=min(8, len(image_list))) as executor:
+        encoded_images = list(executor.map(
+            lambda raw: encode_image_to_base64(raw, max_side), image_list
+        ))
 
-    for img in image_list:
-        base64_img = encode_image_to_base64(img)
+    for mime_type, base64_img in encoded_images:
         content_payload.append({
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_img}",
+                "url": f"data:{mime_type};base64,{base64_img}",
             },
         })
+    content_payload.append({"type": "text", "text": context_msg})
 
-    # 3. 모델 ID 설정 (최신 Llama 4 Scout 적용)
-    # 이전 모델(11b/90b-preview)은 종료되었으므로 아래 모델을 사용해야 합니다.
-    model_id = "meta-llama/llama-4-scout-17b-16e-instruct"
-
-    try:
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {
-                    "role": "user",
-                    "content": content_payload,
-                }
-            ],
-            model=model_id, 
-            temperature=0.5, 
-            max_tokens=6000, 
-        )
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        return f"❌ 오류 발생: {str(e)}"
+    # 스트림 종료 시점에 채워지는 사용량 정보 (프롬프트 캐시 적중 토큰 수)
+    usage = {"cached_tokens": 0, "error": None}
+
+    # 일시적 오류(429/5xx, 연결 끊김)는 지수 백오프로 재시도
+    for attempt in range(4):
+        try:
+            stream = client.chat.completions.create(
+                messages=[
+                    {
+                        "role": "system",
+                        "content": SYSTEM_PROMPT,
+                    },
+                    {
+                        "role": "user",
+                        "content": content_payload,
+                    }
+                ],
+                model=model_id, 
+                temperature=0.5, 
+                top_p=0.9,
+                # Method 섹션은 보통 2500 토큰 이내이며, 참고문헌이 시작되면 생성 중단
+                max_tokens=3000, 
+                stop=["\n# References", "\n## References", "\n### References", "\nReferences\n"],
+                stream=True,
+            )
+            break
+        except (APIStatusError, APIConnectionError) as e:
+            status_code = getattr(e, "status_code", None)
+            retryable = status_code is None or status_code in RETRYABLE_STATUS_CODES
+            if retryable and attempt < 3:
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+            return f"❌ 오류 발생: {str(e)}", usage
+        except Exception as e:
+            return f"❌ 오류 발생: {str(e)}", usage
+
+    # 3. 토큰 단위로 응답을 흘려보내는 제너레이터
+    # 스트리밍 도중 발생한 오류는 usage["error"]에 기록하고 생성을 중단
+    def tokens():
+        try:
+            for chunk in stream:
+                if chunk.choices:
+                    yield chunk.choices[0].delta.content or ""
+                # Groq는 마지막 청크의 x_groq.usage에 사용량을 담아 보냄
+                x_groq = getattr(chunk, "x_groq", None)
+                if getattr(x_groq, "error", None):
+                    usage["error"] = f"❌ 오류 발생: {x_groq.error}"
+                    return
+                chunk_usage = getattr(x_groq, "usage", None)
+                if chunk_usage is not None:
+                    details = getattr(chunk_usage, "prompt_tokens_details", None)
+                    usage["cached_tokens"] = getattr(details, "cached_tokens", None) or 0
+        except Exception as e:
+            usage["error"] = f"❌ 오류 발생: {str(e)}"
+
+    return tokens(), usage
 
 # ==========================================
 # [UI] 화면 구성
@@ -112,6 +204,7 @@ st.title("📄 AI Paper Writer(LMMLab)")
 col1, col2 = st.columns([1, 1])
 
 with col1:
+    model_name = st.selectbox("모델 선택", list(MODELS))
     domain_input = st.text_area(
         "1. 도메인 설명 및 핵심 키워드",
         height=300,
@@ -124,34 +217,53 @@ with col2:
         type=["jpg", "png", "jpeg"],
         accept_multiple_files=True
     )
+
+    # 작은 글씨가 많은 다이어그램만 해상도를 높여서 전송
+    max_side = st.select_slider(
+        "이미지 최대 해상도 (px)",
+        options=[DEFAULT_MAX_SIDE, 1024],
+        value=DEFAULT_MAX_SIDE,
+    )
     
     if uploaded_files:
         st.write(f"✅ 총 {len(uploaded_files)}장의 이미지가 선택되었습니다.")
         tabs = st.tabs([f"이미지 {i+1}" for i in range(len(uploaded_files))])
         
-        pil_images = []
+        # 같은 이미지를 여러 번 올린 경우 한 번만 전송
+        seen = set()
+        pil_bytes = []
         for i, uploaded_file in enumerate(uploaded_files):
-            image = Image.open(uploaded_file)
-            pil_images.append(image)
+            raw = uploaded_file.getvalue()
+            digest = hashlib.blake2b(raw, digest_size=16).digest()
+            if digest not in seen:
+                seen.add(digest)
+                pil_bytes.append(raw)
+            # 미리보기는 원본 바이트를 그대로 사용 (디코딩은 인코딩 시점에만)
             with tabs[i]:
-                st.image(image, caption=uploaded_file.name, use_container_width=True)
+                st.image(raw, caption=uploaded_file.name, use_container_width=True)
     else:
-        pil_images = []
+        pil_bytes = []
 
 st.divider()
 
 if st.button("🚀 논문 작성 시작", type="primary", use_container_width=True):
-    if not pil_images:
+    if not pil_bytes:
         st.error("이미지를 업로드해주세요!")
     else:
         with st.spinner(f'이미지를 분석 중입니다. 잠시만 기다려주세요....'):
-            result = generate_natural_method(GROQ_API_KEY, domain_input, pil_images)
-            
-            st.divider()
-            if "❌" in result:
-                st.error(result)
+            result, usage = generate_natural_method(
+                GROQ_API_KEY, domain_input, pil_bytes, MODELS[model_name], max_side
+            )
+
+        st.divider()
+        if isinstance(result, str):
+            st.error(result)
+        else:
+            st.subheader("📄 생성 결과")
+            result = st.write_stream(result)
+            if usage["error"]:
+                st.error(usage["error"])
             else:
-                st.subheader("📄 생성 결과")
-                st.markdown(result)
+                st.caption(f"⚡ 프롬프트 캐시 적중 토큰: {usage['cached_tokens']}")
                 st.divider()
                 st.text_area("전체 복사 (Ctrl+A)", value=result, height=800)